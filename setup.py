@@ -22,6 +22,10 @@ setup(
                       'pandas',
                       'scikit-image'
                       ],
+    extras_require={'vips': ['pyvips'],
+                    'numba': ['numba'],
+                    'parquet': ['pyarrow'],
+                    'tiffslide': ['tiffslide']},
     classifiers=[
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
@@ -6,3 +6,25 @@ def test_index_last_non_zero():
     assert index_last_non_zero(x) == 3
     x = [2, 5, 4, 3, 7, 0]
     assert index_last_non_zero(x) == 4
+
+
+def test_morton_encode():
+    assert list(morton_encode([0, 0, 1, 1, 2], [0, 1, 0, 1, 0])) == [0, 1, 2, 3, 8]
+
+
+def test_morton_order():
+    h = [3, 0, 2, 1]
+    w = [3, 0, 2, 1]
+    assert list(morton_order(h, w)) == [1, 3, 2, 0]
+
+
+def test_get_level():
+    mags = [40.0, 10.0, 2.5, 0.625]
+    assert get_level(10.0, mags) == 1
+    assert get_level(1.25, mags, threshold=5.0) == 3
+    assert get_level(25.0, mags, threshold=20.0) == 0
+
+
+def test_val_in_list():
+    assert val_in_list(2.5, [40.0, 10.0, 2.5]) == (True, 2)
+    assert val_in_list(3.0, [40.0, 10.0, 2.5]) == (False, None)
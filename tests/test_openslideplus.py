@@ -0,0 +1,107 @@
+import threading
+
+import numpy as np
+from PIL import Image
+
+from wsisampler import openslideplus
+from wsisampler.openslideplus import OpenSlidePlus
+
+
+class FakeSlide(OpenSlidePlus):
+    """
+    An OpenSlidePlus that does not open a file (openslide reads are recorded).
+    """
+    properties = {'openslide.vendor': 'aperio'}
+    level_dimensions = ((1000, 800), (250, 200))
+
+    def __init__(self, file='slide.svs', use_tiffslide=False, use_vips=False):
+        self.file = file
+        self._local = threading.local()
+        self._use_tiffslide = use_tiffslide
+        self._use_vips = use_vips
+        self.downsamples = np.array([1.0, 4.0])
+        self.level_dims = self.level_dimensions
+        self.openslide_reads = []
+
+    def read_region(self, location, level, size):
+        self.openslide_reads.append((location, level, size))
+        return Image.new('RGBA', size, (10, 20, 30, 255))
+
+
+class FakeTiffSlide(object):
+
+    def __init__(self, file, level_dimensions=((1000, 800), (250, 200))):
+        self.level_dimensions = level_dimensions
+        self.closed = False
+
+    def read_region(self, location, level, size):
+        return Image.new('RGBA', size, (1, 2, 3, 255))
+
+    def close(self):
+        self.closed = True
+
+
+class FakeRegion(object):
+
+    def fetch(self, x, y, width, height):
+        return bytes([4, 5, 6]) * (width * height)
+
+
+def test_read_rgb_openslide():
+    slide = FakeSlide()
+    patch = slide._read_rgb(100, 200, 1, 16)
+    assert patch.mode == 'RGB' and patch.size == (16, 16)
+    assert patch.getpixel((0, 0)) == (10, 20, 30)
+    assert slide.openslide_reads == [((100, 200), 1, (16, 16))]
+
+
+def test_read_rgb_tiffslide():
+    slide = FakeSlide(use_tiffslide=True)
+    slide._local.tiffslide = FakeTiffSlide(slide.file)
+    patch = slide._read_rgb(100, 200, 1, 16)
+    assert patch.mode == 'RGB'  # Converted from RGBA.
+    assert patch.getpixel((0, 0)) == (1, 2, 3)
+    assert slide.openslide_reads == []
+
+
+def test_read_rgb_vips():
+    slide = FakeSlide(use_vips=True)
+    slide._vips_region = lambda level: FakeRegion()
+    patch = slide._read_rgb(100, 200, 1, 16)
+    assert patch.mode == 'RGB' and patch.size == (16, 16)
+    assert patch.getpixel((0, 0)) == (4, 5, 6)
+    assert slide.openslide_reads == []
+
+
+def test_read_rgb_vips_edge_falls_back():
+    slide = FakeSlide(use_vips=True)
+    slide._vips_region = lambda level: FakeRegion()
+    patch = slide._read_rgb(990, 0, 0, 16)  # Crosses the right edge of level 0.
+    assert patch.mode == 'RGB'
+    assert patch.getpixel((0, 0)) == (10, 20, 30)
+    assert slide.openslide_reads == [((990, 0), 0, (16, 16))]
+
+
+def test_tiffslide_matches(monkeypatch):
+    class FakeModule(object):
+        TiffSlide = FakeTiffSlide
+
+    monkeypatch.setattr(openslideplus, 'tiffslide', FakeModule)
+    assert FakeSlide('slide.svs')._tiffslide_matches()
+    assert not FakeSlide('slide.ndpi')._tiffslide_matches()
+
+    class VentanaSlide(FakeSlide):
+        properties = {'openslide.vendor': 'ventana'}
+
+    assert not VentanaSlide('slide.tif')._tiffslide_matches()
+
+    class OtherLevels(FakeTiffSlide):
+
+        def __init__(self, file):
+            super(OtherLevels, self).__init__(file, level_dimensions=((1000, 800),))
+
+    FakeModule.TiffSlide = OtherLevels
+    assert not FakeSlide('slide.svs')._tiffslide_matches()
+
+    monkeypatch.setattr(openslideplus, 'tiffslide', None)
+    assert not FakeSlide('slide.svs')._tiffslide_matches()
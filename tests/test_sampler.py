@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from wsisampler.sampler import PATCHFRAME_COLUMNS, Sampler, _ParquetWriter
+
+
+def test_parquet_writer(tmp_path):
+    pytest.importorskip('pyarrow')
+    records = [{'id': 'slide', 'w': 2 * i, 'h': i, 'class': i % 3, 'mag': 20, 'size': 256,
+                'parent': '/data/slide.svs', 'lvl0': 40.0} for i in range(2500)]
+    filename = str(tmp_path / 'slide_patchframe.parquet')
+    writer = _ParquetWriter(filename, batch_size=1024, integer_mag=True)
+    for info in records:
+        writer.append(info)
+    writer.close()
+
+    frame = pd.read_parquet(filename)
+    expected = pd.DataFrame.from_records(records, columns=PATCHFRAME_COLUMNS)
+    assert list(frame.columns) == PATCHFRAME_COLUMNS
+    assert frame['mag'].dtype == expected['mag'].dtype == np.int64
+    pd.testing.assert_frame_equal(frame, expected, check_dtype=False)
+
+
+def test_nonzero_by_rank():
+    rng = np.random.default_rng(0)
+    for trial in range(200):
+        H, W = rng.integers(1, 30, size=2)
+        mask = rng.random((H, W)) < rng.random()
+        mask[rng.random(H) < 0.3] = False  # Empty rows, including first/last rows.
+        mask[rng.integers(H)] = True  # At least one nonzero pixel.
+        row_counts = np.count_nonzero(mask, axis=1)
+        N = int(row_counts.sum())
+        ranks = rng.choice(N, size=rng.integers(1, N + 1), replace=False)
+
+        rows, cols = Sampler._nonzero_by_rank(mask, row_counts, ranks)
+        nonzero = np.nonzero(mask)
+        assert np.array_equal(rows, nonzero[0][ranks])
+        assert np.array_equal(cols, nonzero[1][ranks])
@@ -0,0 +1,33 @@
+import numpy as np
+
+from wsisampler.seedkernels import *
+
+
+def test_tissue_fractions():
+    mask = np.zeros((4, 4), dtype=bool)
+    mask[:2, :2] = True
+    integral = np.zeros((5, 5), dtype=np.int32)
+    integral[1:, 1:] = mask.cumsum(0).cumsum(1)
+    fractions = tissue_fractions([0, 0, 1, 3, 10], [0, 2, 1, 3, 10], integral, 2)
+    assert list(fractions) == [1.0, 0.0, 0.25, 0.0, 1.0]
+
+
+def test_kernels_from_threads():
+    from concurrent.futures import ThreadPoolExecutor
+
+    rng = np.random.default_rng(0)
+    mask = rng.random((64, 64)) > 0.5
+    integral = np.zeros((65, 65), dtype=np.int32)
+    integral[1:, 1:] = mask.cumsum(0).cumsum(1)
+    h = rng.integers(0, 64, size=1000)
+    w = rng.integers(0, 64, size=1000)
+    expected_fractions = tissue_fractions(h, w, integral, 8)
+    expected_codes = morton_encode(h, w)
+
+    def run(_):
+        return tissue_fractions(h, w, integral, 8), morton_encode(h, w)
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        for fractions, codes in pool.map(run, range(64)):
+            assert np.array_equal(fractions, expected_fractions)
+            assert np.array_equal(codes, expected_codes)
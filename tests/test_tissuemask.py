@@ -0,0 +1,49 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from wsisampler.misc import item_in_directory
+from wsisampler.tissuemask import TissueMask
+
+
+def make_tissue_mask():
+    tm = TissueMask.__new__(TissueMask)  # Skip __init__ (needs a WSI).
+    tm.level = 2
+    tm.mag = 1.25
+    tm.ref_factor = 1.25 / 40.0
+    tm.data = np.random.default_rng(0).random((30, 40)) > 0.5
+    return tm
+
+
+def check_loaded(path, tm):
+    loaded = TissueMask.__new__(TissueMask)
+    loaded.load(path)
+    assert (loaded.level, loaded.mag, loaded.ref_factor) == (tm.level, tm.mag, tm.ref_factor)
+    assert np.array_equal(loaded.data, tm.data)
+    return loaded
+
+
+@pytest.mark.parametrize('extension', ['.pickle', '.npy'])
+def test_save_load(tmp_path, extension):
+    tm = make_tissue_mask()
+    tm.save('slide', str(tmp_path))
+    loaded = check_loaded(str(tmp_path / ('slide_TissueMask' + extension)), tm)
+    assert isinstance(loaded.data, np.memmap)
+
+
+def test_load_found_file(tmp_path):
+    tm = make_tissue_mask()
+    tm.save('slide', str(tmp_path))
+    truth, filename = item_in_directory('slide', str(tmp_path))
+    assert truth
+    check_loaded(filename, tm)
+
+
+def test_load_old_pickle(tmp_path):
+    tm = make_tissue_mask()
+    path = str(tmp_path / 'slide_TissueMask.pickle')
+    with open(path, 'wb') as f:
+        pickle.dump(tm, f)
+    loaded = check_loaded(path, tm)
+    assert not isinstance(loaded.data, np.memmap)
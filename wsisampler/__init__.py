@@ -2,6 +2,7 @@ from . import annotation
 from . import misc
 from . import openslideplus
 from . import sampler
+from . import seedkernels
 from . import tissuemask
 
 # For Convenience
@@ -22,8 +22,11 @@ class Annotation(OpenSlide):
         # Get level 0.
         self.level0 = reference_wsi.level0 * self.ref_factor
 
+        # Cache level downsamples (each openslide property access goes through the C library).
+        self.downsamples = np.asarray(self.level_downsamples, dtype=np.float64)
+
         # Get level magnifications.
-        self.mags = [self.level0 / downsample for downsample in self.level_downsamples]
+        self.mags = [self.level0 / downsample for downsample in self.downsamples]
 
     def get_patch(self, w_ref, h_ref, mag, size):
         """
@@ -42,7 +45,8 @@ class Annotation(OpenSlide):
         extraction_mag = self.mags[extraction_level]
         extraction_size = int(size * extraction_mag / mag)
 
-        patch = self.read_region((w, h), extraction_level, (extraction_size, extraction_size)).convert('L')  # Mode 'L' is uint8 grayscale.
+        patch = self.read_region((w, h), extraction_level, (extraction_size, extraction_size)).getchannel(0) \
+            # Labels are grayscale so the red band is the label (mode 'L', uint8).
         if extraction_size != size:
             patch.thumbnail((size, size))  # Resize inplace.
         return patch
@@ -55,9 +59,9 @@ class Annotation(OpenSlide):
         """
         level = get_level(mag=1.25, mags=self.mags, threshold=5.0)
         size = self.level_dimensions[level]
-        low_res = self.read_region((0, 0), level, size).convert('L')  # Mode 'L' is uint8 grayscale.
+        low_res = self.read_region((0, 0), level, size).getchannel(0)  # Red band is the label (mode 'L', uint8).
         low_res_np = np.asarray(low_res)
-        factor = self.level_downsamples[level] / self.ref_factor  # Factor for converting lengths back to reference WSI level 0 frame.
+        factor = self.downsamples[level] / self.ref_factor  # Factor for converting lengths back to reference WSI level 0 frame.
         return low_res_np, factor
 
     def visualize(self, reference_wsi):
@@ -2,11 +2,13 @@
 Utils module
 """
 
+import numpy as np
 import pandas as pd
 import os
 import glob
 
 from wsisampler import openslideplus
+from wsisampler.seedkernels import morton_encode
 
 
 def val_in_list(val, search_list, tol=0.01):
@@ -56,13 +58,13 @@ def item_in_directory(search_key, dir):
 def level_converter(wsi, x, lvl_in, lvl_out):
     """
     Convert a length/coordinate 'x' from lvl_in to lvl_out.
-    :param wsi:
+    :param wsi: OpenSlidePlus
     :param x: a length/coordinate
     :param lvl_in: level to convert from
     :param lvl_out: level to convert to
     :return: New length/coordinate
     """
-    return int(x * wsi.level_downsamples[lvl_in] / wsi.level_downsamples[lvl_out])
+    return int(x * wsi.downsamples[lvl_in] / wsi.downsamples[lvl_out])
 
 
 def get_level(mag, mags, threshold=0.01):
@@ -79,6 +81,19 @@ def get_level(mag, mags, threshold=0.01):
     return level
 
 
+def morton_order(h, w, shift=0):
+    """
+    Indices that sort coordinates in Z-order, so that nearby coordinates are visited together.
+    :param h: integer array of height coordinates
+    :param w: integer array of width coordinates
+    :param shift: coordinates are grouped into cells of side 2 ** shift before encoding.
+    :return: index array
+    """
+    h = np.asarray(h) >> shift
+    w = np.asarray(w) >> shift
+    return np.argsort(morton_encode(h, w), kind='stable')
+
+
 def get_patch_from_info_dict(info):
     """
     Get a patch from an info dict
@@ -93,15 +108,17 @@ def get_patch_from_info_dict(info):
 def save_patchframe_patches(input, save_dir=os.path.join(os.getcwd(), 'patches')):
     """
     Save patches in a patchframe to disk for visualization
-    :param input: patchframe or pickled patchframe
+    :param input: patchframe or pickled/parquet patchframe
     :param save_dir: where to save to
     """
     if isinstance(input, pd.DataFrame):
         patchframe = input
+    elif isinstance(input, str) and input.endswith('.parquet'):
+        patchframe = pd.read_parquet(input)
     elif isinstance(input, str):
         patchframe = pd.read_pickle(input)
     else:
-        raise Exception('Input should be patchframe (pd.DataFrame) or string path to pickled patchframe.')
+        raise Exception('Input should be patchframe (pd.DataFrame) or string path to pickled/parquet patchframe.')
 
     os.makedirs(save_dir, exist_ok=True)
 
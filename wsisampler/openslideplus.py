@@ -1,11 +1,29 @@
+import openslide
 from openslide import OpenSlide
+from PIL import Image
+import numpy as np
 import os
+import threading
 
-from .misc import index_last_non_zero
+try:
+    import pyvips
+except ImportError:
+    pyvips = None
+
+try:
+    import tiffslide
+except ImportError:
+    tiffslide = None
 
 
 class OpenSlidePlus(OpenSlide):
 
+    cache_size = 512 << 20  # Bytes of decoded tiles cached, shared by all slides (needs openslide >= 4.0).
+    _cache = None
+
+    tiffslide_extensions = ('.svs', '.tif', '.tiff')  # Read these with tiffslide (if installed)...
+    tiffslide_vendors = ('aperio', 'generic-tiff')  # ...but only for formats where tiffslide matches openslide.
+
     def __init__(self, file, level0):
         """
         An extension to the OpenSlide class with a method to get a patch by magnification.
@@ -13,6 +31,12 @@ class OpenSlidePlus(OpenSlide):
         :param level0: The 'magnification' at level 0. If 'infer' we attempt to get from metadata.
         """
         super(OpenSlidePlus, self).__init__(file)
+        self.file = file
+        self._local = threading.local()  # Per thread readers (pyvips regions are not thread safe).
+        self._use_vips = pyvips is not None and pyvips.type_find('VipsForeign', 'openslideload') != 0 \
+            # Binary pyvips wheels are often built without openslide support.
+        self._use_tiffslide = self._tiffslide_matches()
+        self._use_shared_cache()
 
         # ID (name) of the WSI.
         self.ID = os.path.splitext(os.path.basename(file))[0]
@@ -27,8 +51,13 @@ class OpenSlidePlus(OpenSlide):
         else:
             self.level0 = float(level0)
 
+        # Cache level geometry (each openslide property access goes through the C library).
+        self.downsamples = np.asarray(self.level_downsamples, dtype=np.float64)
+        self.level_dims = self.level_dimensions
+
         # Compute level magnifications.
-        self.mags = [self.level0 / downsample for downsample in self.level_downsamples]
+        self.mags = [self.level0 / downsample for downsample in self.downsamples]
+        self._neg_mags = -np.asarray(self.mags)  # Ascending, for searchsorted.
 
     def get_patch(self, w, h, mag, size):
         """
@@ -42,13 +71,93 @@ class OpenSlidePlus(OpenSlide):
         """
         assert self.level0 >= mag, 'Magnification not available.'
 
-        higher_mags = [self.mags[i] >= mag for i in range(len(self.mags))]
-        extraction_level = index_last_non_zero(higher_mags)
+        extraction_level = int(np.searchsorted(self._neg_mags, -mag, side='right')) - 1  # Last level with mag >= mag.
         extraction_mag = self.mags[extraction_level]
         extraction_size = int(size * extraction_mag / mag)
 
-        patch = self.read_region((w, h), extraction_level, (extraction_size, extraction_size)).convert('RGB')  # Make sure it's RGB (not e.g. RGBA).
+        patch = self._read_rgb(w, h, extraction_level, extraction_size)
         if extraction_size != size:
             patch.thumbnail((size, size))  # Resize inplace.
         return patch
 
+    def _use_shared_cache(self):
+        """
+        Use a tile cache shared by all slides, larger than openslide's default 32 MiB per slide.
+        Does nothing if openslide is older than 4.0.
+        """
+        try:
+            if OpenSlidePlus._cache is None:
+                OpenSlidePlus._cache = openslide.OpenSlideCache(self.cache_size)
+            self.set_cache(OpenSlidePlus._cache)
+        except (AttributeError, openslide.OpenSlideError):
+            pass
+
+    def _tiffslide_matches(self):
+        """
+        Can we read this slide with tiffslide, using the same levels as openslide?
+        Checks the extension and the openslide vendor, then that tiffslide sees the same level dimensions.
+        :return: bool
+        """
+        if tiffslide is None or os.path.splitext(self.file)[1].lower() not in self.tiffslide_extensions:
+            return False
+        if self.properties.get('openslide.vendor') not in self.tiffslide_vendors:
+            return False
+        try:
+            slide = tiffslide.TiffSlide(self.file)
+        except Exception:
+            return False
+        if tuple(map(tuple, slide.level_dimensions)) != tuple(map(tuple, self.level_dimensions)):
+            print('tiffslide levels differ from openslide levels. Not using tiffslide.')
+            slide.close()
+            return False
+        self._local.tiffslide = slide  # Reuse as this thread's handle.
+        return True
+
+    def _read_rgb(self, w, h, level, size):
+        """
+        Read a square RGB region.
+        TIFF-family slides are read with tiffslide if it is installed, bypassing openslide.
+        Otherwise if pyvips (with openslide support) is installed we fetch the RGB bands directly, \
+            skipping the alpha band and the RGBA -> RGB conversion.
+        :param w: Width coordinate in level 0 frame.
+        :param h: Height coordinate in level 0 frame.
+        :param level: Level to read from.
+        :param size: Region size (square region).
+        :return: PIL image (RGB).
+        """
+        if self._use_tiffslide:
+            patch = self._tiffslide().read_region((w, h), level, (size, size))
+            return patch if patch.mode == 'RGB' else patch.convert('RGB')
+        if self._use_vips:
+            downsample = self.downsamples[level]
+            x, y = int(w / downsample), int(h / downsample)
+            width, height = self.level_dims[level]
+            if x >= 0 and y >= 0 and x + size <= width and y + size <= height:  # pyvips does not pad like openslide.
+                buf = self._vips_region(level).fetch(x, y, size, size)
+                return Image.frombuffer('RGB', (size, size), buf, 'raw', 'RGB', 0, 1)
+        return self.read_region((w, h), level, (size, size)).convert('RGB')  # Make sure it's RGB (not e.g. RGBA).
+
+    def _vips_region(self, level):
+        """
+        Get this thread's pyvips region over the RGB bands of a level.
+        :param level:
+        :return: pyvips.Region
+        """
+        if not hasattr(self._local, 'regions'):
+            self._local.regions = {}
+        region = self._local.regions.get(level)
+        if region is None:
+            image = pyvips.Image.openslideload(self.file, level=level)
+            region = pyvips.Region.new(image[0:3])
+            self._local.regions[level] = region
+        return region
+
+    def _tiffslide(self):
+        """
+        Get this thread's tiffslide handle on the slide.
+        :return: tiffslide.TiffSlide
+        """
+        if not hasattr(self._local, 'tiffslide'):
+            self._local.tiffslide = tiffslide.TiffSlide(self.file)
+        return self._local.tiffslide
+
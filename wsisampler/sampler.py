@@ -3,14 +3,19 @@ Sampler module.
 """
 
 import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
-from random import shuffle
 
 from .openslideplus import OpenSlidePlus
 from .tissuemask import TissueMask
 from .annotation import Annotation
-from .misc import item_in_directory
+from .misc import item_in_directory, morton_order
+
+
+PATCHFRAME_COLUMNS = ['id', 'w', 'h', 'class', 'mag', 'size', 'parent', 'lvl0']
 
 
 class Sampler(object):
@@ -44,99 +49,230 @@ class Sampler(object):
                 print('Annotation mask found. Loading.')
                 self.annotation = Annotation(filename, self.wsi)
 
-    def prepare_sampling(self, magnification, patchsize):
+    def prepare_sampling(self, magnification, patchsize, max_per_class=None, seed=None):
         """
         Prepare to sample patches.
         :param magnification:
         :param patchsize:
+        :param max_per_class: expected maximum number of patches per class. \
+            If given we only keep a random subset of max_per_class seeds per class \
+            (sample_patches only tries the first max_per_class seeds of each class).
+        :param seed: seed for the random number generator (numpy.random.default_rng), for reproducible sampling.
         :return:
         """
         self.mag = magnification
         self.patchsize = patchsize
+        self._max_per_class_hint = max_per_class
+        self.rng = np.random.default_rng(seed)
 
         self.rejected = 0  # to count how many patches we reject.
+        self._rejected_lock = threading.Lock()
 
         self._get_classes_and_seeds()  # get classes and approximate coordinates to 'seed' the patch sampling process.
+        self._class_idx = {c: i for i, c in enumerate(self.class_list)}  # position of each class in self.class_list.
 
-    def sample_patches(self, max_per_class=100, savedir=os.getcwd()):
+    def sample_patches(self, max_per_class=100, savedir=os.getcwd(), n_workers=None, file_format='pickle'):
         """
         Sample patches and save in a patchframe
         :param max_per_class: maximum number of patches per class
         :param savedir: where to save patchframe
+        :param n_workers: number of threads reading patches (default: number of CPUs). \
+            Openslide releases the GIL while decoding so reads overlap.
+        :param file_format: 'pickle' or 'parquet'. \
+            With 'parquet' (requires pyarrow) rows are streamed to disk in batches as patches are accepted.
         """
-        frame = pd.DataFrame(data=None, columns=['id', 'w', 'h', 'class', 'mag', 'size', 'parent', 'lvl0'])
+        assert file_format in ('pickle', 'parquet'), 'file_format should be pickle or parquet.'
+        assert self._max_per_class_hint is None or max_per_class <= self._max_per_class_hint, \
+            'max_per_class is larger than the max_per_class given to prepare_sampling.'
+        n_workers = n_workers or os.cpu_count() or 1
+        max_pending = 4 * n_workers  # Bound the number of patches held in memory.
+
+        os.makedirs(savedir, exist_ok=1)
+        filename = os.path.join(savedir, self.wsi.ID + '_patchframe.' + file_format)
+        writer = None
+        if file_format == 'parquet':
+            writer = _ParquetWriter(filename, integer_mag=isinstance(self.mag, (int, np.integer)))
+        if writer is not None:
+            print('Streaming patchframe to {}'.format(filename))
+
+        records = []
+
+        def collect(future):
+            _, info = future.result()
+            if info is not None:
+                records.append(info)
+                if writer is not None:
+                    writer.append(info)
 
-        for i, c in enumerate(self.class_list):
-            seeds = self.class_seeds[i]
-            for j, seed in enumerate(seeds):
-                _, info = self._class_c_patch_i(c, j)
-                if info is not None:
-                    frame = frame.append(info, ignore_index=1)
-                if j >= (max_per_class - 1):
-                    break
+        try:
+            with ThreadPoolExecutor(max_workers=n_workers) as pool:
+                pending = deque()
+                for c, j in self._seed_order(max_per_class):
+                    pending.append(pool.submit(self._class_c_patch_i, c, j))
+                    if len(pending) >= max_pending:
+                        collect(pending.popleft())
+                while pending:
+                    collect(pending.popleft())
+        finally:
+            if writer is not None:
+                writer.close()  # Always leave a readable file.
+
+        frame = pd.DataFrame.from_records(records, columns=PATCHFRAME_COLUMNS)
 
         print('Rejected {} patches for file {}'.format(self.rejected, self.wsi.ID))
 
-        os.makedirs(savedir, exist_ok=1)
-        filename = os.path.join(savedir, self.wsi.ID + '_patchframe.pickle')
-        print('Saving patchframe to {}'.format(filename))
-        frame.to_pickle(filename)
+        if writer is None:
+            print('Saving patchframe to {}'.format(filename))
+            frame.to_pickle(filename)
 
         return frame
 
     ###
 
+    def _seed_order(self, max_per_class):
+        """
+        The (class, seed index) pairs to try, using the first max_per_class seeds of each class.
+        Seeds of each class are visited in Z-order so neighbouring patches reuse decoded slide tiles.
+        Seeds failing the tissue test are counted as rejected and skipped before any slide is read.
+        :param max_per_class: maximum number of patches per class
+        """
+        shift = max(int(np.log2(self.patchsize * self.wsi.level0 / self.mag)), 0)
+        for c, seeds_h, seeds_w in zip(self.class_list, self.class_seeds_h, self.class_seeds_w):
+            seeds_h = seeds_h[:max_per_class]
+            seeds_w = seeds_w[:max_per_class]
+            fractions = self.tissue_mask.get_tissue_fractions(seeds_w, seeds_h, self.mag, self.patchsize)
+            accept = fractions >= 0.9
+            self._reject(np.count_nonzero(~accept))
+            for j in morton_order(seeds_h, seeds_w, shift):
+                if accept[j]:
+                    yield c, j
+
     def _get_classes_and_seeds(self):
         """
         Get classes and approximate coordinates to 'seed' the patch sampling process.
-        Builds the objects self.class_list and self.class_seeds.
+        Builds the objects self.class_list, self.class_seeds_h and self.class_seeds_w \
+            (height and width coordinates of the seeds of each class).
         """
         # Do class 0 i.e. unannotated first.
         mask = self.tissue_mask.data
-        nonzero = np.nonzero(mask)
-        factor = self.wsi.level_downsamples[self.tissue_mask.level]
-        N = nonzero[0].size
-        coordinates = [(int(nonzero[0][i] * factor), int(nonzero[1][i] * factor)) for i in range(N)]
-        shuffle(coordinates)
+        factor = self.wsi.downsamples[self.tissue_mask.level]
+        seeds_h, seeds_w = self._mask_to_seeds(mask, factor, self._max_per_class_hint)
         self.class_list = [0]
-        self.class_seeds = [coordinates]
+        self.class_seeds_h = [seeds_h]
+        self.class_seeds_w = [seeds_w]
 
         # If no annotation we're done.
         if self.annotation is None:
             return
 
         # Now add other classes.
+        # Sort the pixels by label once (stable radix sort for uint8) rather than scanning the annotation per class.
         annotation_low_res, factor = self.annotation.get_low_res_numpy()
-        classes = sorted(list(np.unique(annotation_low_res)))
+        flat = annotation_low_res.ravel()
+        order = np.argsort(flat, kind='stable')
+        sorted_labels = flat[order]
+        starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+        ends = np.r_[starts[1:], flat.size]
+        classes = sorted_labels[starts]
 
         assert classes[0] == 0
-        classes = classes[1:]
 
-        for c in classes:
-            mask = (annotation_low_res == c)
-            nonzero = np.nonzero(mask)
-            N = nonzero[0].size
-            coordinates = [(int(nonzero[0][i] * factor), int(nonzero[1][i] * factor)) for i in range(N)]
-            shuffle(coordinates)
+        W = annotation_low_res.shape[1]
+        for c, start, end in zip(classes[1:], starts[1:], ends[1:]):
+            pixels = order[start:end]
+            pixels = pixels[self._random_subset(pixels.size, self._max_per_class_hint)]
+            rows, cols = np.divmod(pixels, W)
+            seeds_h, seeds_w = self._scale_seeds(rows, cols, factor)
             self.class_list.append(c)
-            self.class_seeds.append(coordinates)
+            self.class_seeds_h.append(seeds_h)
+            self.class_seeds_w.append(seeds_w)
+
+    def _mask_to_seeds(self, mask, factor, max_seeds=None):
+        """
+        Get (h, w) coordinates of the nonzero pixels of a mask in random order, scaled by factor.
+        :param mask: low resolution mask.
+        :param factor: factor for converting lengths to reference WSI level 0 frame.
+        :param max_seeds: if given, only keep a random subset of this many coordinates.
+        :return: (h, w) int32 arrays.
+        """
+        row_counts = np.count_nonzero(mask, axis=1)
+        N = int(row_counts.sum())
+        idx = self._random_subset(N, max_seeds)
+        if idx.size == N:
+            nonzero = np.nonzero(mask)
+            rows, cols = nonzero[0][idx], nonzero[1][idx]
+        else:
+            rows, cols = self._nonzero_by_rank(mask, row_counts, idx)
+        return self._scale_seeds(rows, cols, factor)
+
+    def _random_subset(self, N, max_seeds=None):
+        """
+        Random indices into N items: a permutation of all of them, or max_seeds of them without replacement.
+        :param N: number of items.
+        :param max_seeds: maximum number of indices (None for no limit).
+        :return: index array.
+        """
+        if max_seeds is None or max_seeds >= N:
+            return self.rng.permutation(N)
+        return self.rng.choice(N, size=max_seeds, replace=False)
+
+    @staticmethod
+    def _scale_seeds(rows, cols, factor):
+        """
+        Convert low resolution (row, col) coordinates to (h, w) coordinates in reference WSI level 0 frame.
+        :param rows: row coordinates.
+        :param cols: column coordinates.
+        :param factor: factor for converting lengths to reference WSI level 0 frame.
+        :return: (h, w) int32 arrays.
+        """
+        seeds_h = np.empty(rows.size, dtype=np.int32)
+        seeds_w = np.empty(cols.size, dtype=np.int32)
+        np.multiply(rows, factor, out=seeds_h, casting='unsafe')
+        np.multiply(cols, factor, out=seeds_w, casting='unsafe')
+        return seeds_h, seeds_w
+
+    @staticmethod
+    def _nonzero_by_rank(mask, row_counts, ranks):
+        """
+        Get the coordinates of some nonzero pixels of a mask, without listing all of them.
+        The kth nonzero pixel (in row-major order) is found from the per row counts, \
+            so only the rows containing a chosen pixel are scanned again.
+        :param mask: 2D mask.
+        :param row_counts: number of nonzero pixels in each row of the mask.
+        :param ranks: which nonzero pixels to get (k for the kth).
+        :return: (rows, cols) int64 arrays, in the order of ranks.
+        """
+        row_starts = np.cumsum(row_counts) - row_counts
+        rows = np.searchsorted(row_starts, ranks, side='right') - 1  # Empty rows share the start of the next row.
+        offsets = ranks - row_starts[rows]
+
+        cols = np.empty(ranks.size, dtype=np.int64)
+        order = np.argsort(rows, kind='stable')
+        unique_rows, first = np.unique(rows[order], return_index=True)
+        for row, group in zip(unique_rows, np.split(order, first[1:])):
+            cols[group] = np.flatnonzero(mask[row])[offsets[group]]
+        return rows.astype(np.int64), cols
 
     def _class_c_patch_i(self, c, i):
         """
         Try and get the ith patch of class c. If we reject return (None, None).
+        NOTE: The tissue test is not repeated here, seeds are filtered by tissue in _seed_order.
         :param c: class
         :param i: index
         :return: (patch, info_dict) or (None, None) if we reject patch.
         """
-        idx = self.class_list.index(c)
-        h, w = self.class_seeds[idx][i]
-        patch = self.wsi.get_patch(w, h, self.mag, self.patchsize)
+        idx = self._class_idx[c]
+        h = int(self.class_seeds_h[idx][i])  # Python ints for openslide.
+        w = int(self.class_seeds_w[idx][i])
 
-        tissue_mask_patch = self.tissue_mask.get_patch(w, h, self.mag, self.patchsize)
-        if np.sum(tissue_mask_patch) / np.prod(tissue_mask_patch.shape) < 0.9:
-            self.rejected += 1
-            return None, None
+        # Check the annotation first so we only read the WSI for accepted patches.
+        if self.annotation is not None:
+            annotation_patch = self.annotation.get_patch(w, h, self.mag, self.patchsize)
+            annotation_patch = np.asarray(annotation_patch)
+            if np.count_nonzero(annotation_patch == c) < 0.9 * annotation_patch.size:
+                return self._reject()
 
+        patch = self.wsi.get_patch(w, h, self.mag, self.patchsize)
         info = {
             'w': w,
             'h': h,
@@ -147,16 +283,64 @@ class Sampler(object):
             'id': self.wsi.ID,
             'lvl0': self.wsi.level0
         }
+        return patch, info
 
-        # If no annotation we're done.
-        if self.annotation is None:
-            return patch, info
+    def _reject(self, n=1):
+        """
+        Count rejected patches (thread safe).
+        :param n: number of patches rejected
+        :return: (None, None)
+        """
+        with self._rejected_lock:
+            self.rejected += n
+        return None, None
 
-        annotation_patch = self.annotation.get_patch(w, h, self.mag, self.patchsize)
-        annotation_patch = np.asarray(annotation_patch)
-        mask = (annotation_patch == c).astype(float)
-        if np.sum(mask) / np.prod(mask.shape) < 0.9:
-            self.rejected += 1
-            return None, None
 
-        return patch, info
+class _ParquetWriter(object):
+
+    def __init__(self, filename, batch_size=1024, integer_mag=False):
+        """
+        Stream patchframe rows to a parquet file, one record batch at a time.
+        :param filename: parquet file to write.
+        :param batch_size: number of rows per record batch.
+        :param integer_mag: store mag as int64 (as the pickled patchframe does for an int magnification).
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.schema = pa.schema([('id', pa.string()),
+                                 ('w', pa.int64()),
+                                 ('h', pa.int64()),
+                                 ('class', pa.int64()),
+                                 ('mag', pa.int64() if integer_mag else pa.float64()),
+                                 ('size', pa.int64()),
+                                 ('parent', pa.string()),
+                                 ('lvl0', pa.float64())])
+        self.writer = pq.ParquetWriter(filename, self.schema)  # Strings (id, parent) are dictionary encoded.
+        self.batch_size = batch_size
+        self.rows = []
+
+    def append(self, info):
+        """
+        Add a row, writing a record batch once batch_size rows are waiting.
+        :param info: info dict
+        """
+        self.rows.append(info)
+        if len(self.rows) >= self.batch_size:
+            self._flush()
+
+    def close(self):
+        """
+        Write the remaining rows and close the file.
+        """
+        self._flush()
+        self.writer.close()
+
+    def _flush(self):
+        if self.rows:
+            columns = [[row[name] for row in self.rows] for name in self.schema.names]
+            self.writer.write_batch(self.pa.RecordBatch.from_arrays(
+                [self.pa.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+                schema=self.schema))
+            self.rows = []
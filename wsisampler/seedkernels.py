@@ -0,0 +1,116 @@
+"""
+Seed kernels module.
+Loops over many seeds, compiled with numba if it is installed (otherwise vectorized numpy is used).
+The kernels are safe to call from several threads.
+"""
+
+import threading
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+
+
+def _part1by1(x):
+    """
+    Spread the lower 32 bits of x so there is a zero bit between each.
+    Works on uint64 arrays, and on uint64 scalars inside numba kernels.
+    :param x: uint64 array or scalar
+    :return: uint64 array or scalar
+    """
+    x = x & np.uint64(0x00000000FFFFFFFF)
+    x = (x | (x << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    x = (x | (x << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    x = (x | (x << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    x = (x | (x << np.uint64(2))) & np.uint64(0x3333333333333333)
+    x = (x | (x << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return x
+
+
+def _morton_encode_numpy(h, w):
+    return (_part1by1(h.astype(np.uint64)) << np.uint64(1)) | _part1by1(w.astype(np.uint64))
+
+
+def _morton_encode_loop(h, w):
+    codes = np.empty(h.size, dtype=np.uint64)
+    for k in prange(h.size):
+        codes[k] = (_part1by1_jit(np.uint64(h[k])) << np.uint64(1)) | _part1by1_jit(np.uint64(w[k]))
+    return codes
+
+
+def _tissue_fractions_numpy(h, w, integral, patchsize):
+    H, W = integral.shape[0] - 1, integral.shape[1] - 1
+    h0, h1 = np.clip(h, 0, H), np.clip(h + patchsize, 0, H)
+    w0, w1 = np.clip(w, 0, W), np.clip(w + patchsize, 0, W)
+    tissue = integral[h1, w1] - integral[h0, w1] - integral[h1, w0] + integral[h0, w0]
+    area = (h1 - h0) * (w1 - w0)
+    fractions = np.ones(h.size)
+    np.divide(tissue, area, out=fractions, where=area > 0)
+    return fractions
+
+
+def _tissue_fractions_loop(h, w, integral, patchsize):
+    H, W = integral.shape[0] - 1, integral.shape[1] - 1
+    fractions = np.ones(h.size)
+    for k in prange(h.size):
+        h0, h1 = min(max(h[k], 0), H), min(max(h[k] + patchsize, 0), H)
+        w0, w1 = min(max(w[k], 0), W), min(max(w[k] + patchsize, 0), W)
+        area = (h1 - h0) * (w1 - w0)
+        if area > 0:
+            tissue = integral[h1, w1] - integral[h0, w1] - integral[h1, w0] + integral[h0, w0]
+            fractions[k] = tissue / area
+    return fractions
+
+
+if njit is not None:
+    _part1by1_jit = njit(cache=True)(_part1by1)
+    _morton_encode_jit = njit(parallel=True, cache=True)(_morton_encode_loop)
+    _morton_encode_serial_jit = njit(cache=True)(_morton_encode_loop)
+    _tissue_fractions_jit = njit(parallel=True, cache=True)(_tissue_fractions_loop)
+    _tissue_fractions_serial_jit = njit(cache=True)(_tissue_fractions_loop)
+
+
+def _parallel_allowed():
+    """
+    Parallel kernels are only run from the main thread.
+    Numba's workqueue threading layer aborts the process if parallel kernels are entered from several threads.
+    """
+    return threading.current_thread() is threading.main_thread()
+
+
+def morton_encode(h, w):
+    """
+    Morton (Z-order) code of coordinates, by interleaving the bits of h and w.
+    :param h: integer array of height coordinates
+    :param w: integer array of width coordinates
+    :return: uint64 array of codes
+    """
+    h = np.asarray(h, dtype=np.int64)
+    w = np.asarray(w, dtype=np.int64)
+    if njit is None:
+        return _morton_encode_numpy(h, w)
+    if _parallel_allowed():
+        return _morton_encode_jit(h, w)
+    return _morton_encode_serial_jit(h, w)
+
+
+def tissue_fractions(h, w, integral, patchsize):
+    """
+    Fraction of tissue in square windows of a mask, from its summed-area table.
+    Windows are clipped to the mask.
+    :param h: integer array of window top coordinates (mask frame)
+    :param w: integer array of window left coordinates (mask frame)
+    :param integral: summed-area table of shape (H + 1, W + 1), integral[i, j] = mask[:i, :j].sum()
+    :param patchsize: window size
+    :return: array of fractions (1.0 for windows entirely outside the mask)
+    """
+    h = np.asarray(h, dtype=np.int64)
+    w = np.asarray(w, dtype=np.int64)
+    if njit is None:
+        return _tissue_fractions_numpy(h, w, integral, patchsize)
+    if _parallel_allowed():
+        return _tissue_fractions_jit(h, w, integral, patchsize)
+    return _tissue_fractions_serial_jit(h, w, integral, patchsize)